@@ -1,14 +1,29 @@
-import subprocess
+import atexit
+import io
 import tempfile
+import time
+import uuid
 import os
 import asyncio
+from typing import TYPE_CHECKING
 import mcp.types as types
 from mcp.server.models import InitializationOptions
 from mcp.server import NotificationOptions, Server
 import mcp.server.stdio
-import base64
 from PIL import Image
-import io
+
+try:
+    from pybase64 import b64encode_as_string
+except ImportError:
+    import base64
+
+    def b64encode_as_string(s: bytes) -> str:
+        return base64.b64encode(s).decode("ascii")
+
+
+if TYPE_CHECKING:
+    from _typeshed import ReadableBuffer
+
 
 server = Server("illustrator")
 
@@ -22,53 +37,49 @@ Instead, call `log(message)` each time you want to log a message. I have already
 """
 
 
-@server.list_tools()
-async def handle_list_tools() -> list[types.Tool]:
-    return [
-        types.Tool(
-            name="view",
-            description="View a screenshot of the Adobe Illustrator window",
-            inputSchema={
-                "type": "object",
-                "properties": {},
-            },
-        ),
-        types.Tool(
-            name="run",
-            description=RUN_DESCRIPTION,
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "code": {
-                        "type": "string",
-                        "description": "ExtendScript/JavaScript code to execute",
-                    }
-                },
-                "required": ["code"],
-            },
-        ),
-    ]
+# Prepended to the user's code so `log()` is available
+JSX_PREFIX = """
+var __alert_output = [];
+var log = function(message) {
+    __alert_output.push(message);
+};
 
+// TODO why doesn't this work?
+app.userInteractionLevel = UserInteractionLevel.DONTDISPLAYALERTS
 
-def captureIllustrator() -> types.CallToolResult:
-    screenshot_path = None
-    try:
-        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as f:
-            screenshot_path = f.name
+"""
 
-        capture_script = (
-            """
-            -- Save the previously active app so we can restore it later
-            tell application "System Events"
-                set frontApp to name of first process where frontmost is true
-            end tell
+# The last line becomes the return value to AppleScript
+JSX_SUFFIX = """
+__alert_output.join("\\n");
+"""
+
+
+CAPTURE_SCRIPT = """
+on run argv
+    set screenshotPath to item 1 of argv
 
-            -- Bring Illustrator to the front
-            tell application "Adobe Illustrator"
-                activate
-                delay 1
+    try
+        -- Save the previously active app so we can restore it later
+        tell application "System Events"
+            set frontApp to name of first process where frontmost is true
+        end tell
+
+        -- Bring Illustrator to the front, waiting up to 1.5s for it to get there
+        tell application "Adobe Illustrator"
+            activate
+        end tell
+        repeat 30 times
+            tell application "System Events"
+                if (name of first process whose frontmost is true) is "Adobe Illustrator" then exit repeat
             end tell
+            delay 0.05
+        end repeat
 
+        if (count of argv) > 1 then
+            -- Reuse the coordinates from a recent capture
+            set windowInfo to item 2 of argv
+        else
             tell application "System Events"
                 tell process "Adobe Illustrator"
                     -- Get the screen coordinates
@@ -76,28 +87,312 @@ def captureIllustrator() -> types.CallToolResult:
                     set {x, y} to position of frontWindow
                     set {width, height} to size of frontWindow
                     set windowInfo to "" & x & "," & y & "," & width & "," & height
-
-                    -- Take the screenshot of those coordinates
-                    do shell script "screencapture -R " & quoted form of windowInfo & " -x '%s'"
                 end tell
             end tell
+        end if
 
-            -- Re-activate the previously active app
-            tell application frontApp
-                activate
-            end tell
-        """
-            % screenshot_path
+        -- Take the screenshot of those coordinates
+        do shell script "screencapture -R " & quoted form of windowInfo & " -t jpg -x " & quoted form of screenshotPath
+
+        -- Re-activate the previously active app
+        tell application frontApp
+            activate
+        end tell
+
+        return "SUCCESS: " & windowInfo
+    on error errMsg
+        return "ERROR: " & errMsg
+    end try
+end run
+"""
+
+
+RUN_SCRIPT = """
+on run argv
+    set jsxCode to item 1 of argv
+
+    tell application "Adobe Illustrator"
+        set user interaction level to never interact
+        try
+            set result to do javascript jsxCode
+            return result
+        on error errMsg
+            return "ERROR: " & errMsg
+        end try
+    end tell
+end run
+"""
+
+
+# Built once, list_tools requests just return it
+TOOLS = [
+    types.Tool(
+        name="view",
+        description="View a screenshot of the Adobe Illustrator window",
+        inputSchema={
+            "type": "object",
+            "properties": {},
+        },
+    ),
+    types.Tool(
+        name="run",
+        description=RUN_DESCRIPTION,
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "code": {
+                    "type": "string",
+                    "description": "ExtendScript/JavaScript code to execute",
+                }
+            },
+            "required": ["code"],
+        },
+    ),
+]
+
+
+@server.list_tools()
+async def handle_list_tools() -> list[types.Tool]:
+    return TOOLS
+
+
+# Compiled .scpt paths, keyed by script source
+_compiled_scripts: dict[str, str] = {}
+_compile_lock = asyncio.Lock()
+
+
+@atexit.register
+def _remove_compiled_scripts() -> None:
+    for path in _compiled_scripts.values():
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+async def compileScript(source: str) -> str:
+    """Compile AppleScript source once and return the path to the .scpt file."""
+    # Concurrent first calls would otherwise compile the same source twice
+    async with _compile_lock:
+        if source in _compiled_scripts:
+            return _compiled_scripts[source]
+
+        fd, path = tempfile.mkstemp(suffix=".scpt")
+        os.close(fd)
+        proc = await asyncio.create_subprocess_exec(
+            "osacompile",
+            "-o",
+            path,
+            "-e",
+            source,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        _, err = await proc.communicate()
+        if proc.returncode != 0:
+            os.unlink(path)
+            raise RuntimeError(err.decode("utf-8").strip())
+
+        _compiled_scripts[source] = path
+        return path
+
+
+def _applescript_string(value: str) -> str:
+    # AppleScript literals only understand \\, \", \n, \r and \t escapes. Any
+    # other character is valid as-is, except that line breaks would split the
+    # statement sent to the worker
+    escaped = (
+        value.replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+    return f'"{escaped}"'
+
+
+# Seconds to wait for a single worker call, e.g. when Illustrator is stuck on
+# a modal dialog, before giving up and restarting the worker
+SCRIPT_TIMEOUT = 120
+
+
+class OsascriptWorker:
+    """A long-lived `osascript -i` process that runs one statement at a time."""
+
+    def __init__(self) -> None:
+        self._proc: asyncio.subprocess.Process | None = None
+        self._lock = asyncio.Lock()
+
+    async def _start(self) -> asyncio.subprocess.Process:
+        return await asyncio.create_subprocess_exec(
+            "osascript",
+            "-i",
+            "-l",
+            "AppleScript",
+            # Print results human-readable, as `osascript -e` does, so string
+            # results come back without quotes
+            "-s",
+            "h",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
         )
 
-        subprocess.run(["osascript", "-e", capture_script], check=True)
+    async def _read_response(
+        self, stdout: asyncio.StreamReader, sentinel: bytes
+    ) -> bytes:
+        out = bytearray()
+        while True:
+            try:
+                out += await stdout.readuntil(sentinel)
+                break
+            except asyncio.LimitOverrunError as e:
+                # Output is longer than the reader's buffer limit, take what is
+                # buffered so far and keep looking for the sentinel
+                out += await stdout.readexactly(e.consumed)
+        await stdout.readline()
+        return bytes(out)
+
+    async def _exchange(
+        self, proc: asyncio.subprocess.Process, statement: str
+    ) -> bytes:
+        assert proc.stdin is not None and proc.stdout is not None
+        # Evaluating the sentinel literal echoes it back once the statement
+        # before it has finished, which frames the response. It is unique per
+        # call so output that happens to contain an old one cannot end the read
+        sentinel = uuid.uuid4().hex
+        proc.stdin.write(f'{statement}\n"{sentinel}"\n'.encode("utf-8"))
+        await proc.stdin.drain()
+        return await self._read_response(proc.stdout, sentinel.encode("utf-8"))
+
+    async def run(self, statement: str) -> bytes:
+        async with self._lock:
+            if self._proc is None or self._proc.returncode is not None:
+                self._proc = await self._start()
+            proc = self._proc
+
+            try:
+                out = await asyncio.wait_for(
+                    self._exchange(proc, statement), SCRIPT_TIMEOUT
+                )
+            except BaseException as e:
+                # The stream is out of sync now, start over on the next call
+                if proc.returncode is None:
+                    proc.kill()
+                self._proc = None
+                if isinstance(e, asyncio.TimeoutError):
+                    raise RuntimeError(
+                        f"osascript did not respond within {SCRIPT_TIMEOUT} seconds"
+                    ) from e
+                raise
+
+        return _parse_worker_output(out)
+
+
+def _parse_worker_output(out: bytes) -> bytes:
+    # Drop the partial line holding the sentinel, then the ">> " prompt (if
+    # osascript prints one) and "=> " result marker in front of the output;
+    # everything in between is the statement's output exactly as printed
+    if b"\n" not in out:
+        return b""
+    output = out.rsplit(b"\n", 1)[0]
+    return output.removeprefix(b">> ").removeprefix(b"=> ")
+
+
+_worker = OsascriptWorker()
+
+RUN_STATEMENT = "run script (POSIX file %s) with parameters {%s}"
+
+
+async def runCompiledScript(source: str, *args: str) -> bytes:
+    script_path = await compileScript(source)
+    statement = RUN_STATEMENT % (
+        _applescript_string(script_path),
+        ", ".join(_applescript_string(arg) for arg in args),
+    )
+    return (await _worker.run(statement)).strip()
+
+
+# How long the window's screen coordinates are reused before asking System
+# Events again
+WINDOW_RECT_TTL = 0.5
+
+# (time.monotonic() of the capture, "x,y,width,height") from the last capture
+_last_rect: tuple[float, str] | None = None
+
+# Screenshots larger than this get re-encoded to keep the payload small
+MAX_SCREENSHOT_BYTES = 1024 * 1024
+
+
+class Base64Sink(io.RawIOBase):
+    """Writable stream that base64-encodes whatever is written to it."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.parts: list[str] = []
+        self._rem = b""
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: "ReadableBuffer", /) -> int:
+        view = memoryview(data)
+        # Encode in multiples of 3 bytes so no padding ends up mid-stream
+        buf = self._rem + view
+        n = len(buf) // 3 * 3
+        self.parts.append(b64encode_as_string(buf[:n]))
+        self._rem = buf[n:]
+        return view.nbytes
+
+    def close(self) -> None:
+        # IOBase also calls close() on garbage collection, only pad once
+        if not self.closed:
+            self.parts.append(b64encode_as_string(self._rem))
+            self._rem = b""
+        super().close()
+
+    def getvalue(self) -> str:
+        return "".join(self.parts)
+
+
+def _encode_jpeg(screenshot_path: str) -> str:
+    with open(screenshot_path, "rb") as fh:
+        data = fh.read()
+    if len(data) <= MAX_SCREENSHOT_BYTES:
+        return b64encode_as_string(data)
+
+    sink = Base64Sink()
+    with Image.open(screenshot_path) as img, io.BufferedWriter(sink) as fp:
+        rgb = img if img.mode == "RGB" else img.convert("RGB")
+        rgb.save(
+            fp,
+            format="JPEG",
+            quality=80,
+            optimize=True,
+            progressive=True,
+            subsampling="4:2:0",
+        )
+    return sink.getvalue()
 
-        with Image.open(screenshot_path) as img:
-            if img.mode in ("RGBA", "LA"):
-                img = img.convert("RGB")
-            buffer = io.BytesIO()
-            img.save(buffer, format="JPEG", quality=85, optimize=True)
-            screenshot_data = base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+async def captureIllustrator() -> types.CallToolResult:
+    global _last_rect
+    fd, screenshot_path = tempfile.mkstemp(suffix=".jpg")
+    os.close(fd)
+    try:
+        args = [screenshot_path]
+        if _last_rect and time.monotonic() - _last_rect[0] < WINDOW_RECT_TTL:
+            args.append(_last_rect[1])
+        output = await runCompiledScript(CAPTURE_SCRIPT, *args)
+        if not output.startswith(b"SUCCESS:"):
+            _last_rect = None
+            raise RuntimeError(
+                output.replace(b"ERROR:", b"", 1).strip().decode("utf-8")
+            )
+        window_info = output[len(b"SUCCESS:") :].strip().decode("utf-8")
+        _last_rect = (time.monotonic(), window_info)
+
+        # Reading and possibly re-encoding the image blocks, keep it off the loop
+        screenshot_data = await asyncio.to_thread(_encode_jpeg, screenshot_path)
 
         return types.CallToolResult(
             content=[
@@ -115,67 +410,36 @@ def captureIllustrator() -> types.CallToolResult:
             isError=True,
         )
     finally:
-        if screenshot_path and os.path.exists(screenshot_path):
+        try:
             os.unlink(screenshot_path)
+        except FileNotFoundError:
+            pass
 
 
-def runIllustratorScript(code: str) -> types.CallToolResult:
+async def runIllustratorScript(code: str) -> types.CallToolResult:
     try:
-        wrapped_code = f"""
-        var __alert_output = [];
-        var log = function(message) {{
-            __alert_output.push(message);
-        }};
-
-        // TODO why doesn't this work?
-        app.userInteractionLevel = UserInteractionLevel.DONTDISPLAYALERTS
-
-        {code}
-
-        // The last line becomes the return value to AppleScript
-        __alert_output.join("\\\n");
-        """
-
-        # Write it to a temporary file
-        with tempfile.NamedTemporaryFile(suffix=".jsx", delete=False) as tmp_file:
-            tmp_file_path = tmp_file.name
-            tmp_file.write(wrapped_code.encode("utf-8"))
-
-        applescript = f"""
-            tell application "Adobe Illustrator"
-                set user interaction level to never interact
-                try
-                    set result to do javascript file "{tmp_file_path}"
-                    return result
-                on error errMsg
-                    return "ERROR: " & errMsg
-                end try
-            end tell
-        """
-
-        result = subprocess.run(
-            ["osascript", "-e", applescript], capture_output=True, text=True
-        )
-        output = result.stdout.strip()
+        wrapped_code = JSX_PREFIX + code + JSX_SUFFIX
 
-        # Clean up the temporary file
-        os.unlink(tmp_file_path)
+        output = await runCompiledScript(RUN_SCRIPT, wrapped_code)
 
-        if output.startswith("ERROR:"):
+        if output.startswith(b"ERROR:"):
+            message = output[len(b"ERROR:") :].strip().decode("utf-8")
             return types.CallToolResult(
                 content=[
                     types.TextContent(
                         type="text",
-                        text=f"Error: {output.replace('ERROR:', '').strip()}",
+                        text=f"Error: {message}",
                     )
                 ],
                 isError=True,
             )
 
+        output_text = output.decode("utf-8")
         return types.CallToolResult(
             content=[
                 types.TextContent(
-                    type="text", text=f"Script executed successfully\nOutput: {output}"
+                    type="text",
+                    text=f"Script executed successfully\nOutput: {output_text}",
                 )
             ],
             isError=False,
@@ -192,7 +456,7 @@ async def handleCallTool(
     name: str, arguments: dict | None
 ) -> list[types.TextContent | types.ImageContent | types.EmbeddedResource]:
     if name == "view":
-        result = captureIllustrator()
+        result = await captureIllustrator()
         return result.content
     elif name == "run":
         if not arguments or "code" not in arguments:
@@ -201,7 +465,7 @@ async def handleCallTool(
                     type="text", text="Error: The 'code' parameter is required"
                 )
             ]
-        result = runIllustratorScript(arguments["code"])
+        result = await runIllustratorScript(arguments["code"])
         return result.content
     else:
         return [types.TextContent(type="text", text=f"Error: Unknown tool '{name}'")]
@@ -0,0 +1,164 @@
+import asyncio
+import base64
+import os
+import sys
+
+from illustrator import server
+from illustrator.server import (
+    Base64Sink,
+    OsascriptWorker,
+    _applescript_string,
+    _parse_worker_output,
+)
+
+# `osascript -s h` prints string results without quotes
+SENTINEL_LINE = b"=> 0123456789abcdef0123456789abcdef"
+
+
+def frame(output: bytes) -> bytes:
+    # What the worker reads up to and including the sentinel
+    return output + b"\n" + SENTINEL_LINE
+
+
+def test_single_line():
+    assert _parse_worker_output(frame(b"=> hello")) == b"hello"
+
+
+def test_keeps_blank_lines():
+    output = b"=> line1\nline2\n\nline4"
+    assert _parse_worker_output(frame(output)) == b"line1\nline2\n\nline4"
+
+
+def test_keeps_quotes_and_backslashes():
+    output = b'=> "a \\"quoted\\" C:\\\\path"'
+    assert _parse_worker_output(frame(output)) == b'"a \\"quoted\\" C:\\\\path"'
+
+
+def test_keeps_multiline_quotes():
+    output = b'=> "first\nsecond"'
+    assert _parse_worker_output(frame(output)) == b'"first\nsecond"'
+
+
+def test_only_strips_first_result_marker():
+    output = b"=> a\n=> b"
+    assert _parse_worker_output(frame(output)) == b"a\n=> b"
+
+
+def test_strips_leading_prompt():
+    output = b">> => hello"
+    assert _parse_worker_output(frame(output)) == b"hello"
+
+
+def test_no_output():
+    assert _parse_worker_output(SENTINEL_LINE) == b""
+
+
+def test_applescript_string_escapes():
+    value = 'a\\b "c"\nd\re'
+    assert _applescript_string(value) == '"a\\\\b \\"c\\"\\nd\\re"'
+
+
+def test_applescript_string_keeps_other_control_characters():
+    assert _applescript_string("x\fy\x00z\té") == '"x\fy\x00z\té"'
+
+
+def test_base64_sink_round_trip():
+    data = os.urandom(1000)
+    sink = Base64Sink()
+    pos = 0
+    for size in (1, 2, 4, 5, 7, 11, 13, 100, 1000):
+        sink.write(data[pos : pos + size])
+        pos += size
+    sink.close()
+    assert sink.getvalue() == base64.b64encode(data).decode("ascii")
+
+
+def test_base64_sink_close_is_idempotent():
+    sink = Base64Sink()
+    sink.write(b"ab")
+    sink.close()
+    sink.close()
+    assert sink.getvalue() == "YWI="
+
+
+# Stands in for `osascript -i -s h`: evaluates each line it reads as a string
+# literal when quoted and prints it after "=> "
+ECHO_WORKER = """
+import sys
+for line in sys.stdin:
+    line = line.rstrip("\\n")
+    if line.startswith('"') and line.endswith('"'):
+        line = line[1:-1]
+    sys.stdout.write("=> " + line + "\\n")
+    sys.stdout.flush()
+"""
+
+
+async def exchange(statements: list[str]) -> list[bytes]:
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-c",
+        ECHO_WORKER,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+    )
+    worker = OsascriptWorker()
+    try:
+        return [
+            _parse_worker_output(await worker._exchange(proc, statement))
+            for statement in statements
+        ]
+    finally:
+        proc.kill()
+        await proc.wait()
+
+
+def test_exchange_ignores_markers_in_output():
+    old_marker = "0123456789abcdef0123456789abcdef"
+    assert asyncio.run(exchange([old_marker, "second"])) == [
+        old_marker.encode("utf-8"),
+        b"second",
+    ]
+
+
+def test_exchange_reads_past_stream_limit():
+    big = "x" * 70000
+    assert asyncio.run(exchange([big, "next"])) == [big.encode("utf-8"), b"next"]
+
+
+def fake_worker(monkeypatch, output: bytes) -> None:
+    async def runCompiledScript(source: str, *args: str) -> bytes:
+        return _parse_worker_output(frame(output)).strip()
+
+    monkeypatch.setattr(server, "runCompiledScript", runCompiledScript)
+
+
+def test_capture_success(monkeypatch):
+    fake_worker(monkeypatch, b"=> SUCCESS: 0,0,10,10")
+    monkeypatch.setattr(server, "_last_rect", None)
+    result = asyncio.run(server.captureIllustrator())
+    assert not result.isError
+    assert result.content[0].type == "image"
+    assert server._last_rect is not None
+    assert server._last_rect[1] == "0,0,10,10"
+
+
+def test_capture_error(monkeypatch):
+    fake_worker(monkeypatch, b"=> ERROR: Illustrator has no windows")
+    result = asyncio.run(server.captureIllustrator())
+    assert result.isError
+    assert result.content[0].text == "Error: Illustrator has no windows"
+
+
+def test_run_output(monkeypatch):
+    fake_worker(monkeypatch, b"=> a\n\nb")
+    result = asyncio.run(server.runIllustratorScript('log("a")'))
+    assert not result.isError
+    assert result.content[0].text == "Script executed successfully\nOutput: a\n\nb"
+
+
+def test_run_error(monkeypatch):
+    fake_worker(monkeypatch, b"=> ERROR: Error 21: undefined is not an object.")
+    result = asyncio.run(server.runIllustratorScript("x.y"))
+    assert result.isError
+    assert result.content[0].text == "Error: Error 21: undefined is not an object."